@@ -1,10 +1,26 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from datetime import datetime
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+import orjson
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
-import win32com.client as win32
+import logging
+import os
+import sqlite3
+import threading
 import time
+from zipfile import ZipFile, ZIP_DEFLATED
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.writer.excel import ExcelWriter
 
 
 # Load configuration from ini file
@@ -13,265 +29,479 @@ config.read('config.ini')
 
 # Jira API URL and authentication details
 JIRA_URL = config['JIRA']['URL']
+# Enhanced JQL search endpoint on the same Jira site, paginated with nextPageToken
+SEARCH_URL = '{0.scheme}://{0.netloc}/rest/api/3/search/jql'.format(urlsplit(JIRA_URL))
 AUTH = HTTPBasicAuth(config['JIRA']['USERNAME'], config['JIRA']['API_TOKEN'])
 HEADERS = {"Accept": "application/json"}
 
-MAX_RESULTS = int(config['SETTINGS']['MAX_RESULTS'])
-# Number of days to highlight recent comments
-HIGHLIGHT_DAYS = int(config['SETTINGS']['HIGHLIGHT_DAYS'])
-
-# Number of recent comments to include in the Excel report
-RECENT_COMMENTS_COUNT = int(config['SETTINGS']['RECENT_COMMENTS_COUNT'])
-
-# File name prefix for the Excel report
-FILE_NAME_PREFIX = config['SETTINGS']['FILE_NAME_PREFIX']
-# File name postfix for the Excel report
-FILE_NAME_POSTFIX = config['SETTINGS']['FILE_NAME_POSTFIX']
-# 获取保存目录
-save_directory = config.get('Paths', 'save_directory')
-
-# Cache for storing comments of issues
-comments_cache = {}
+@dataclass(frozen=True)
+class Settings:
+    """Report settings, read once from the [SETTINGS] and [Paths] sections of config.ini."""
+    pool_size: int
+    max_workers: int
+    max_results: int
+    highlight_days: int
+    recent_comments_count: int
+    file_name_prefix: str
+    file_name_postfix: str
+    compress_level: int
+    save_directory: str
+
+    @classmethod
+    def from_config(cls, config):
+        """Read the settings from a ConfigParser, applying their defaults and limits."""
+        section = config['SETTINGS']
+        pool_size = section.getint('POOL_SIZE', fallback=60)
+        return cls(
+            # Number of connections kept open to Jira
+            pool_size=pool_size,
+            # Number of concurrent Jira requests, shared by all sheets. The workers mostly
+            # wait on the network, so use several per CPU, but no more than the pool size
+            max_workers=min(section.getint('MAX_WORKERS', fallback=(os.cpu_count() or 1) * 8), pool_size),
+            # Jira Cloud caps the search page size at 100
+            max_results=min(int(section['MAX_RESULTS']), 100),
+            # Number of days to highlight recent comments
+            highlight_days=int(section['HIGHLIGHT_DAYS']),
+            # Number of recent comments to include in the Excel report
+            recent_comments_count=int(section['RECENT_COMMENTS_COUNT']),
+            # File name prefix and postfix for the Excel report
+            file_name_prefix=section['FILE_NAME_PREFIX'],
+            file_name_postfix=section['FILE_NAME_POSTFIX'],
+            # Zip compression level of the report: 1 saves fastest, 9 gives the smallest file
+            compress_level=section.getint('COMPRESS_LEVEL', fallback=1),
+            # 获取保存目录
+            save_directory=config.get('Paths', 'save_directory'),
+        )
+
+SETTINGS = Settings.from_config(config)
+
+# Shared HTTP session so all threads reuse keep-alive connections to Jira
+SESSION = requests.Session()
+SESSION.auth = AUTH
+SESSION.headers.update(HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=SETTINGS.pool_size,
+    pool_maxsize=SETTINGS.pool_size,
+    # The JQL search is a read-only POST, so it is safe to retry as well
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST'])),
+))
+# (connect, read) timeouts in seconds, so a stalled connection can't hang a worker
+REQUEST_TIMEOUT = (5, 30)
+# Single pool running the HTTP work of all sheets, sized to the connection pool
+http_executor = ThreadPoolExecutor(max_workers=SETTINGS.max_workers)
+
+# Issue fields requested from the search API; comments are included so they
+# don't need a separate request per issue
+ISSUE_FIELDS = ['summary', 'assignee', 'status', 'priority', 'updated', 'labels', 'comment']
+
+# Disk cache shared across runs. The comments table holds the raw comment
+# response of each issue along with its updated timestamp and the number of
+# comments asked for, so changed issues or settings fetch them again; the
+# comments are formatted when read, in the timezone of the current run
+cache_db = sqlite3.connect(os.path.join(SETTINGS.save_directory, '.jira_cache.sqlite'), check_same_thread=False)
+cache_db.execute('CREATE TABLE IF NOT EXISTS comments (issue_key TEXT PRIMARY KEY, updated TEXT, max_results INTEGER, cached_at REAL, comments_json BLOB, etag TEXT)')
+# The connection is shared by the worker threads, guard it
+cache_lock = threading.Lock()
+# Number of seconds before a cached comment list is fetched again anyway
+COMMENTS_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Local timezone used to display Jira timestamps, looked up once
+LOCAL_TZ = datetime.now().astimezone().tzinfo
 
 # Debug switch for timing
 DEBUG_TIMING = False
 
-def fetch_issues(jql_query):
-    """Fetch all issues from Jira based on the JQL query."""
-    if DEBUG_TIMING:
-        start_time = time.time()
-    start_at = 0
-    all_issues = []
-    while True:
-        params = {'jql': jql_query, 'maxResults': MAX_RESULTS, 'startAt': start_at}
-        response = requests.get(JIRA_URL, headers=HEADERS, auth=AUTH, params=params)
-        response.raise_for_status()
-        issues = response.json().get('issues', [])
-        if not issues:
-            break
-        all_issues.extend(issues)
-        start_at += MAX_RESULTS
-    if DEBUG_TIMING:
-        end_time = time.time()
-        print(f"fetch_issues took {end_time - start_time:.2f} seconds")
-    return all_issues
-
-def fetch_comments(issue_key):
-    """Fetch the last few comments for a given Jira issue."""
-    if DEBUG_TIMING:
-        start_time = time.time()
-    if issue_key in comments_cache:
-        return comments_cache[issue_key]
+log = logging.getLogger(__name__)
 
-    comments_url = f"https://metainfra.atlassian.net/rest/api/3/issue/{issue_key}"
-    response = requests.get(comments_url, headers=HEADERS, auth=AUTH)
+@contextmanager
+def timed(message, *args):
+    """Log how long the enclosed block took, only when debug logging is enabled."""
+    if not log.isEnabledFor(logging.DEBUG):
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        log.debug(message + " took %.2f seconds", *args, time.perf_counter() - start_time)
+
+def submit_request(fn, *args):
+    """Submit an HTTP call to the shared pool.
+
+    With debug logging enabled, logs how long the call waited for a worker and
+    how long it ran, to help tune the MAX_WORKERS and POOL_SIZE settings.
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return http_executor.submit(fn, *args)
+    submitted_time = time.perf_counter()
+
+    def run():
+        start_time = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            log.debug("%s waited %.2f seconds for a worker and ran %.2f seconds",
+                      fn.__name__, start_time - submitted_time, time.perf_counter() - start_time)
+    return http_executor.submit(run)
+
+def fetch_issue_page(jql_query, next_page_token=None):
+    """Fetch one page of the Jira search results, continuing from next_page_token."""
+    payload = {'jql': jql_query, 'maxResults': SETTINGS.max_results, 'fields': ISSUE_FIELDS}
+    if next_page_token:
+        payload['nextPageToken'] = next_page_token
+    response = SESSION.post(SEARCH_URL, json=payload, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
-    comments_data = response.json().get('fields', {}).get('comment', {}).get('comments', [])
-    comments_list = []
+    return orjson.loads(response.content)
 
-    def extract_text(content):
-        """Recursively extract text from the content."""
-        if isinstance(content, list):
-            return ''.join(extract_text(item) for item in content)
-
-        if not isinstance(content, dict):
-            return str(content)
-
-        if content['type'] == 'text':
-            return content['text']
-        elif content['type'] == 'mention':
-            return content['attrs']['text']
-        elif content['type'] == 'hardBreak':
-            return "\n"
-        elif 'content' in content:
-            return ''.join(extract_text(item) for item in content['content'])
-        return ""
-
-    # Only take the last few comments based on RECENT_COMMENTS_COUNT
-    for comment in comments_data[-RECENT_COMMENTS_COUNT:][::-1]:
+def fetch_issues(jql_query):
+    """Fetch all issues from Jira based on the JQL query.
+
+    This is a generator yielding the issues page by page as the pages arrive,
+    so callers can start working on the first issues while the rest download.
+    """
+    with timed("fetch_issues"):
+        page = fetch_issue_page(jql_query)
+        while True:
+            # Request the next page before handing out this one
+            next_page_token = page.get('nextPageToken')
+            next_page = submit_request(fetch_issue_page, jql_query, next_page_token) if next_page_token else None
+            yield from page.get('issues', [])
+            if next_page is None:
+                break
+            page = next_page.result()
+
+# Text produced by the ADF node types that carry text directly
+_ADF_HANDLERS = {
+    'text': lambda node: node['text'],
+    'mention': lambda node: node['attrs']['text'],
+    'hardBreak': lambda node: "\n",
+}
+
+def extract_text(content):
+    """Extract the text from Atlassian Document Format content."""
+    # Most comment bodies are a single paragraph of text, mentions and line
+    # breaks; join its leaves directly and only walk anything deeper
+    if isinstance(content, list) and len(content) == 1 and content[0].get('type') == 'paragraph':
+        parts = []
+        for node in content[0].get('content', ()):
+            handler = _ADF_HANDLERS.get(node.get('type'))
+            if handler:
+                parts.append(handler(node))
+            elif 'content' in node:
+                break
+        else:
+            return ''.join(parts)
+
+    parts = []
+    stack = [content]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+            continue
+
+        if not isinstance(node, dict):
+            parts.append(str(node))
+            continue
+
+        handler = _ADF_HANDLERS.get(node.get('type'))
+        if handler:
+            parts.append(handler(node))
+        elif 'content' in node:
+            stack.extend(reversed(node['content']))
+    return ''.join(parts)
+
+def parse_jira_time(value):
+    """Parse a Jira timestamp such as 2024-05-04T10:00:00.000+0800."""
+    # Before Python 3.11 datetime.fromisoformat needs a colon in the UTC offset
+    if value[-5] in '+-':
+        value = value[:-2] + ':' + value[-2:]
+    return datetime.fromisoformat(value)
+
+def format_comments(comments_data):
+    """Format a list of Jira comments (newest first) for the Excel report.
+
+    Returns (created_time, text) tuples, created_time being the local creation
+    time of the comment or None if the comment could not be parsed.
+    """
+    comments_list = []
+    for comment in comments_data:
         try:
             author = comment['updateAuthor']['displayName']
-            created_time = comment['created']
             comment_body = extract_text(comment['body']['content'])
 
             # Combine the full comment content
             # Convert created time to local timezone
-            created_time = datetime.strptime(created_time, '%Y-%m-%dT%H:%M:%S.%f%z')
-            local_created_time = created_time.astimezone().strftime('%Y-%m-%d %H:%M:%S')
+            created_time = parse_jira_time(comment['created']).astimezone(LOCAL_TZ)
+            local_created_time = created_time.strftime('%Y-%m-%d %H:%M:%S')
             full_comment = f"**[{local_created_time}, {author}]**\n{comment_body}"
-            comments_list.append(full_comment)
-        except (KeyError, IndexError) as e:
-            comments_list.append(f"Error parsing comment: {str(e)}")
-
-    comments_cache[issue_key] = comments_list  # Cache the comments
-    if DEBUG_TIMING:
-        end_time = time.time()
-        print(f"fetch_comments for {issue_key} took {end_time - start_time:.2f} seconds")
-    return comments_list  # Return the list of comments, not a combined string
+            comments_list.append((created_time, full_comment))
+        except (KeyError, IndexError, ValueError) as e:
+            comments_list.append((None, f"Error parsing comment: {str(e)}"))
+    return comments_list
 
-def extract_labels(issue, prefix):
-    """Extract labels from an issue based on a given prefix."""
-    labels = [label[len(prefix):] for label in issue['fields']['labels'] if label.startswith(prefix)]
-    return ','.join(labels)
+def fetch_comments(issue_key, updated):
+    """Fetch the last few comments for a given Jira issue."""
+    max_results = SETTINGS.recent_comments_count
+    with cache_lock:
+        cached = cache_db.execute('SELECT updated, cached_at, comments_json, etag FROM comments WHERE issue_key = ? AND max_results = ?',
+                                  (issue_key, max_results)).fetchone()
+    if cached and cached[0] == updated and time.time() - cached[1] < COMMENTS_CACHE_TTL:
+        return format_comments(orjson.loads(cached[2]).get('comments', []))
+
+    with timed("fetch_comments for %s", issue_key):
+        comments_url = f"https://metainfra.atlassian.net/rest/api/3/issue/{issue_key}/comment"
+        # Only ask for the last few comments based on the recent comments count, newest first
+        params = {'orderBy': '-created', 'maxResults': max_results}
+        # Revalidate an older cache entry with its ETag, so unchanged comments come back as an empty 304
+        etag = cached[3] if cached else None
+        headers = {'If-None-Match': etag} if etag else None
+        response = SESSION.get(comments_url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            comments_json = cached[2]
+        else:
+            response.raise_for_status()
+            comments_json = response.content
+        comments_list = format_comments(orjson.loads(comments_json).get('comments', []))
+
+    # Cache the raw response, replacing the entry of an older version of the issue
+    with cache_lock:
+        cache_db.execute('INSERT OR REPLACE INTO comments (issue_key, updated, max_results, cached_at, comments_json, etag) VALUES (?, ?, ?, ?, ?, ?)',
+                         (issue_key, updated, max_results, time.time(), comments_json, response.headers.get('ETag', etag)))
+    return comments_list  # Return the list of comments, not a combined string
 
+def extract_recent_comments(issue):
+    """Extract the last few comments from an issue returned by the search API.
+
+    Returns None if the search API truncated the comment thread, those comments
+    have to be fetched separately with fetch_comments.
+    """
+    comment_field = issue['fields'].get('comment') or {}
+    comments_data = comment_field.get('comments', [])
+    if comment_field.get('total', 0) > len(comments_data):
+        return None
+    # Only take the last few comments based on the recent comments count
+    return format_comments(comments_data[-SETTINGS.recent_comments_count:][::-1])
+
+def split_labels(issue, prefixes):
+    """Split the issue labels by their "prefix:" in a single pass.
+
+    Returns a dict of each prefix to its comma-separated label values.
+    """
+    values = {prefix: [] for prefix in prefixes}
+    for label in issue['fields']['labels']:
+        prefix, sep, value = label.partition(':')
+        if sep and prefix in values:
+            values[prefix].append(value)
+    return {prefix: ','.join(found) for prefix, found in values.items()}
+
+def fetch_sheet_data(sheet_name, jql_query):
+    """Fetch the issues of one JQL query and build the report rows for its sheet.
+
+    Returns the rows, for each row its list of (created_time, text) comments, and
+    the longest text of each auto-fit column (C, E and F).
+    """
+    with timed("Fetching issues and comments for %s", sheet_name):
+        print(f"Processing JQL Query: {sheet_name}")
+        # Comments come with the search results; only truncated comment threads
+        # need a request, started while the next pages are still downloading
+        issues = []
+        row_comments = []  # 這裡獲取的是評論列表
+        pending = {}
+        for issue in fetch_issues(jql_query):
+            comments = extract_recent_comments(issue)
+            if comments is None:
+                pending[len(issues)] = submit_request(fetch_comments, issue['key'], issue['fields']['updated'])
+            issues.append(issue)
+            row_comments.append(comments)
+        print(f"{sheet_name}: fetched {len(issues)} issues")
+        for index, _ in enumerate(as_completed(pending.values()), start=1):
+            progress = (index / len(pending)) * 100
+            print(f"{sheet_name}: fetched comments of {index}/{len(pending)} issues ({progress:.2f}%)")
+        for index, future in pending.items():
+            row_comments[index] = future.result()
+
+    # Build the report column by column, keeping the order returned by the query
+    fields = [issue['fields'] for issue in issues]
+    issue_keys = [issue['key'] for issue in issues]
+    summaries = [f['summary'] for f in fields]
+    assignees = [(f['assignee'] or {}).get('displayName', 'Unassigned') for f in fields]
+    statuses = [f['status']['name'] for f in fields]
+    priorities = [(f['priority'] or {}).get('name', 'None') for f in fields]
+    # Convert update time to local timezone
+    update_times = [parse_jira_time(f['updated']).astimezone(LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S') for f in fields]
+    # Extract labels
+    labels = [split_labels(issue, ('issue-category', 'gerrit')) for issue in issues]
+    sensor_issue_categories = [label['issue-category'] for label in labels]
+    gerrit_ids = [label['gerrit'] for label in labels]
+    # Combine all comments into one cell
+    combined_comments = ["\n\n".join(comment for _, comment in comments) for comments in row_comments]
+    remarks = [""] * len(issues)
+    rows = list(zip(issue_keys, summaries, assignees, statuses, priorities, update_times,
+                    sensor_issue_categories, gerrit_ids, combined_comments, remarks))
+    # Track the longest value of the auto-fit columns while the column lists are at hand
+    column_widths = {'C': max(map(len, assignees), default=0),
+                     'E': max(map(len, priorities), default=0),
+                     'F': max(map(len, update_times), default=0)}
+    return rows, row_comments, column_widths
+
+# Styles of the Excel report
+HEADER_FILL = PatternFill('solid', fgColor='FFFF00')
+REMARK_HEADER_FILL = PatternFill('solid', fgColor='CAD8E6')
+HEADER_FONT = Font(name='Calibri', bold=True)
+WRAP_TOP = Alignment(wrap_text=True, vertical='top')
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+# Rich text fonts for the comments cell: bold "[time, author]" headers, recent comments in blue
+HIGHLIGHT_FONT = InlineFont(rFont='Calibri', color='0000FF')
+BOLD_FONT = InlineFont(rFont='Calibri', b=True)
+BOLD_HIGHLIGHT_FONT = InlineFont(rFont='Calibri', b=True, color='0000FF')
+# Named styles of the report cells, registered once per workbook so that each
+# cell takes its whole style in a single assignment
+INFO_STYLE = NamedStyle(name='Report Info', font=Font(name='Calibri'), fill=HEADER_FILL, alignment=WRAP_TOP, border=THIN_BORDER)
+HEADER_STYLE = NamedStyle(name='Report Header', font=HEADER_FONT, fill=HEADER_FILL, alignment=WRAP_TOP, border=THIN_BORDER)
+REMARK_HEADER_STYLE = NamedStyle(name='Report Remark Header', font=HEADER_FONT, fill=REMARK_HEADER_FILL, alignment=WRAP_TOP, border=THIN_BORDER)
+CELL_STYLE = NamedStyle(name='Report Cell', font=Font(name='Calibri'), alignment=WRAP_TOP, border=THIN_BORDER)
+LINK_STYLE = NamedStyle(name='Report Link', font=Font(name='Calibri', color='0563C1', underline='single'), alignment=WRAP_TOP, border=THIN_BORDER)
+REPORT_STYLES = (INFO_STYLE, HEADER_STYLE, REMARK_HEADER_STYLE, CELL_STYLE, LINK_STYLE)
+
+def comments_rich_text(comments, highlight_cutoff):
+    """Build the comments cell text with bold headers and recent comments highlighted."""
+    runs = []
+
+    def add_run(text, font=None):
+        """Append a run of text, merging it into the previous run if that has the same font."""
+        last = runs[-1] if runs else None
+        if font is None and isinstance(last, str):
+            runs[-1] = last + text
+        elif font is not None and isinstance(last, TextBlock) and last.font is font:
+            last.text += text
+        else:
+            runs.append(TextBlock(font, text) if font else text)
+
+    body_font = None
+    for comment_time, comment in comments:
+        if runs:
+            # The separator takes the font of the previous comment, so adjacent
+            # recent comments end up in a single highlighted run
+            add_run("\n\n", body_font)
+        if comment_time is None:
+            body_font = None
+            add_run(comment)
+            continue
+        # Bold the "[time, author]" header between the ** markers
+        header_end = comment.index(']**') + 1
+        if comment_time > highlight_cutoff:
+            body_font, header_font = HIGHLIGHT_FONT, BOLD_HIGHLIGHT_FONT
+            log.debug("Highlighted comment: %s", comment)
+        else:
+            body_font, header_font = None, BOLD_FONT
+            log.debug("Comment not highlighted (older than %d days): %s", SETTINGS.highlight_days, comment)
+        add_run(comment[:2], body_font)
+        add_run(comment[2:header_end], header_font)
+        add_run(comment[header_end:], body_font)
+    return CellRichText(runs) if runs else ""
+
+def write_sheet(ws, jql_query, rows, row_comments, column_widths):
+    """Write the report rows of one JQL query to an Excel sheet."""
+    # The sheet is streamed in write-only mode, so the column widths and the
+    # height of the first row have to be set before any row is appended
+    headers = ["Jira Ticket ID", "Summary", "PIC", "Status", "Priority", "Update Time", "Sensor Issue Category", "Gerrit ID", "Comments", "Remark"]
+    format_excel(ws, headers, column_widths)
+    ws.row_dimensions[1].height = 50
+
+    # Insert the JQL query, highlight days, and recent comments count into the first row with line breaks;
+    # the rest of the merged range is written as empty styled cells so that the border goes all around it
+    info = f"JQL Query: {jql_query}\nHighlight Days: {SETTINGS.highlight_days}\nRecent Comments Count: {SETTINGS.recent_comments_count}"
+    ws.append(styled_cells(ws, [info] + [None] * (len(headers) - 1), INFO_STYLE))
+    ws.merged_cells.add("A1:J1")
+
+    # Add the header row for the issues, with the 10th column header in blue
+    header_cells = styled_cells(ws, headers, HEADER_STYLE)
+    header_cells[-1].style = REMARK_HEADER_STYLE.name
+    ws.append(header_cells)
+
+    # Comments newer than this are highlighted, i.e. less than highlight days + 1 full days old
+    highlight_cutoff = datetime.now(LOCAL_TZ) - timedelta(days=SETTINGS.highlight_days + 1)
+
+    # Write the rows below the two header rows, with the ticket ID as a HYPERLINK() formula to Jira
+    # rather than a hyperlink relationship per row
+    for row, comments in zip(rows, row_comments):
+        link = f'=HYPERLINK("https://metainfra.atlassian.net/browse/{row[0]}", "{row[0]}")'
+        cells = styled_cells(ws, (link,) + row[1:8] + (comments_rich_text(comments, highlight_cutoff),) + row[9:], CELL_STYLE)
+        cells[0].style = LINK_STYLE.name
+        ws.append(cells)
+
+def styled_cells(ws, values, style):
+    """Create the cells of one sheet row with the given named style, ready for ws.append."""
+    cells = [WriteOnlyCell(ws, value) for value in values]
+    for cell in cells:
+        cell.style = style.name
+    return cells
+
+@timed("create_excel")
 def create_excel(queries):
     """Create an Excel file with the fetched Jira issues and their details."""
-    if DEBUG_TIMING:
-        start_time = time.time()
-    excel = win32.gencache.EnsureDispatch('Excel.Application')
-    #excel = win32.Dispatch('Excel.Application')
-    wb = excel.Workbooks.Add()
-    
-    for sheet_name, jql_query in queries.items():
-        if DEBUG_TIMING:
-            sheet_start_time = time.time()
-        ws = wb.Worksheets.Add()
-        ws.Name = sheet_name
-        
-        # Insert the JQL query, HIGHLIGHT_DAYS, and RECENT_COMMENTS_COUNT into the first row with line breaks
-        ws.Cells(1, 1).Value = f"JQL Query: {jql_query}\nHighlight Days: {HIGHLIGHT_DAYS}\nRecent Comments Count: {RECENT_COMMENTS_COUNT}"
-        ws.Cells(1, 1).Interior.Color = 65535
-        ws.Cells(1, 1).WrapText = True  # Enable text wrapping
-        ws.Range(ws.Cells(1, 1), ws.Cells(1, 10)).Merge()
-                
-        # Set the row height of the first row to 50
-        ws.Rows(1).RowHeight = 50
-        
-        # Add the header row for the issues
-        headers = ["Jira Ticket ID", "Summary", "PIC", "Status", "Priority", "Update Time", "Sensor Issue Category", "Gerrit ID", "Comments", "Remark"]
-        for col_num, header in enumerate(headers, 1):
-            ws.Cells(2, col_num).Value = header
-            ws.Cells(2, col_num).Interior.Color = 65535
-            ws.Cells(2, col_num).Font.Bold = True
-
-        # Set the background color of the 10th column header to blue
-        ws.Cells(2, 10).Interior.Color = 15128778
-
-        if DEBUG_TIMING:
-            fetch_issues_start_time = time.time()
-        issues = fetch_issues(jql_query)
-        if DEBUG_TIMING:
-            fetch_issues_end_time = time.time()
-            print(f"fetch_issues for {sheet_name} took {fetch_issues_end_time - fetch_issues_start_time:.2f} seconds")
-
-        if DEBUG_TIMING:
-            fetch_comments_start_time = time.time()
-        rows = []
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            future_to_issue = {executor.submit(fetch_comments, issue['key']): issue for issue in issues}
-            print(f"Processing JQL Query: {sheet_name}")
-            for index, future in enumerate(as_completed(future_to_issue), start=1):
-                issue = future_to_issue[future]
-                issue_key = issue['key']
-                summary = issue['fields']['summary']
-                assignee = issue['fields']['assignee']['displayName'] if issue['fields']['assignee'] else 'Unassigned'
-                status = issue['fields']['status']['name']
-                priority = issue['fields']['priority']['name'] if issue['fields']['priority'] else 'None'
-                updated = issue['fields']['updated']
-                comments = future.result()  # 這裡獲取的是評論列表
-
-                # Extract labels
-                sensor_issue_category = extract_labels(issue, 'issue-category:')
-                gerrit_id = extract_labels(issue, 'gerrit:')
-
-                # Convert update time to local timezone
-                update_time = datetime.strptime(updated, '%Y-%m-%dT%H:%M:%S.%f%z')
-                local_update_time = update_time.astimezone().strftime('%Y-%m-%d %H:%M:%S')
-
-                # Combine all comments into one cell
-                combined_comments = "\n\n".join(comments)
-                rows.append([issue_key, summary, assignee, status, priority, local_update_time, sensor_issue_category, gerrit_id, combined_comments, ""])
-
-                progress = (index / len(issues)) * 100
-                print(f"Processed {index}/{len(issues)} issues ({progress:.2f}%)")
-
-        if DEBUG_TIMING:
-            fetch_comments_end_time = time.time()
-            print(f"fetch_comments for {sheet_name} took {fetch_comments_end_time - fetch_comments_start_time:.2f} seconds")
-
-        # Write all rows to the worksheet at once
-        ws.Range(ws.Cells(3, 1), ws.Cells(len(rows) + 2, len(headers))).Value = rows
-
-        # Set hyperlinks and format comments
-        for row_num, row in enumerate(rows, start=3):
-            ws.Hyperlinks.Add(Anchor=ws.Cells(row_num, 1), Address=f"https://metainfra.atlassian.net/browse/{row[0]}", TextToDisplay=row[0])
-            for comment in row[8].split("\n\n"):
-                if '**' in comment:
-                    start = row[8].find(comment)
-                    bold_start = comment.find('**') + 2
-                    bold_end = comment.find('**', bold_start)
-                    if bold_end != -1:
-                        ws.Cells(row_num, 9).GetCharacters(Start=start + bold_start + 1, Length=bold_end - bold_start).Font.Bold = True
-                if "**[" in comment and "]**" in comment:
-                    comment_time_str = comment.split("**[")[1].split(", ")[0]
-                    try:
-                        comment_time = datetime.strptime(comment_time_str, '%Y-%m-%d %H:%M:%S')
-                        if (datetime.now(comment_time.tzinfo) - comment_time).days <= HIGHLIGHT_DAYS:
-                            start = row[8].find(comment)
-                            ws.Cells(row_num, 9).GetCharacters(Start=start + 1, Length=len(comment)).Font.Color = 16711680
-                            if DEBUG_TIMING:
-                                print(f"Highlighted comment: {comment}")
-                        else:
-                            if DEBUG_TIMING:
-                                print(f"Comment not highlighted (older than {HIGHLIGHT_DAYS} days): {comment}")
-                    except (ValueError, IndexError) as e:
-                        if DEBUG_TIMING:
-                            print(f"Error parsing comment time: {e}")
-                            print(f"Comment: {comment}")
-
-        format_excel(ws)
-        if DEBUG_TIMING:
-            sheet_end_time = time.time()
-            print(f"Processing sheet {sheet_name} took {sheet_end_time - sheet_start_time:.2f} seconds")
-    
-    save_excel(wb, excel)
-    if DEBUG_TIMING:
-        end_time = time.time()
-        print(f"create_excel took {end_time - start_time:.2f} seconds")
-
-def format_excel(ws):
-    """Format the Excel sheet with appropriate styles and widths."""
-    
-    # 設置單元格對齊方式為自動換行和頂部對齊
-    ws.Cells.WrapText = True
-    ws.Cells.VerticalAlignment = win32.constants.xlTop
-
-    # 調整每一欄的寬度
-    ws.Columns.AutoFit()
+    wb = Workbook(write_only=True)
+    for style in REPORT_STYLES:
+        wb.add_named_style(style)
+
+    # Fetch all queries concurrently; the sheets are written here in query
+    # order as their data becomes available
+    with ThreadPoolExecutor(max_workers=max(1, min(len(queries), 8))) as executor:
+        sheet_futures = [(sheet_name, jql_query, executor.submit(fetch_sheet_data, sheet_name, jql_query))
+                         for sheet_name, jql_query in queries.items()]
+        for sheet_name, jql_query, future in sheet_futures:
+            rows, row_comments, column_widths = future.result()
+            with timed("Writing sheet %s", sheet_name):
+                ws = wb.create_sheet(title=sheet_name)
+                write_sheet(ws, jql_query, rows, row_comments, column_widths)
+
+    save_excel(wb)
+
+def format_excel(ws, headers, column_widths):
+    """Set the column widths of the Excel sheet from the header row and the longest value of each auto-fit column."""
+
+    # 調整每一欄的寬度 (only the columns that are not given a fixed width below)
+    for column, index in (('C', 2), ('E', 4), ('F', 5)):
+        ws.column_dimensions[column].width = max(len(headers[index]), column_widths[column]) + 2
 
     # 設置特定欄的寬度
-    ws.Columns(1).ColumnWidth = 12
-    ws.Columns(2).ColumnWidth = 50
-    ws.Columns(4).ColumnWidth = 15
-    ws.Columns(7).ColumnWidth = 20
-    ws.Columns(8).ColumnWidth = 8
-    ws.Columns(9).ColumnWidth = 100
-    ws.Columns(10).ColumnWidth = 50
-
-    # 設置單元格邊框和字體
-    used_range = ws.UsedRange
-    used_range.Borders.LineStyle = win32.constants.xlContinuous
-    used_range.Borders.Weight = win32.constants.xlThin
-    used_range.Font.Name = 'Calibri'
-
-def save_excel(wb, excel):
+    ws.column_dimensions['A'].width = 12
+    ws.column_dimensions['B'].width = 50
+    ws.column_dimensions['D'].width = 15
+    ws.column_dimensions['G'].width = 20
+    ws.column_dimensions['H'].width = 8
+    ws.column_dimensions['I'].width = 100
+    ws.column_dimensions['J'].width = 50
+
+def save_excel(wb):
     """Save the Excel workbook to a file."""
     current_time = datetime.now().strftime("%m-%d_%H.%M")
-    file_name = f"{FILE_NAME_PREFIX}_jira_issues_{FILE_NAME_POSTFIX}.xlsx"
-    file_path = rf"{save_directory}\{file_name}"
-    wb.SaveAs(file_path)
-    wb.Close()
-    excel.Quit()
+    file_name = f"{SETTINGS.file_name_prefix}_jira_issues_{SETTINGS.file_name_postfix}.xlsx"
+    file_path = os.path.join(SETTINGS.save_directory, file_name)
+    # Do what wb.save(file_path) does, but with the configured compression level: a
+    # write-only workbook needs at least one sheet, and the modified time is set on save
+    if not wb.worksheets:
+        wb.create_sheet()
+    wb.properties.modified = datetime.now(timezone.utc).replace(tzinfo=None)
+    with ZipFile(file_path, 'w', ZIP_DEFLATED, allowZip64=True, compresslevel=SETTINGS.compress_level) as archive:
+        ExcelWriter(wb, archive).save()
     print(f"Jira issues have been written to {file_name}")
 
 def main():
     """Main function to fetch Jira issues and create an Excel report."""
+    logging.basicConfig(level=logging.DEBUG if DEBUG_TIMING else logging.WARNING, format='%(message)s')
     print("Sending request to Jira...")
     try:
         queries = {key: value for key, value in config['QUERY'].items()}
         create_excel(queries)
     except requests.RequestException as e:
         print(f"Failed to fetch issues: {e}")
+    finally:
+        http_executor.shutdown()
+        cache_db.commit()
+        cache_db.close()
 
 if __name__ == "__main__":
     main()